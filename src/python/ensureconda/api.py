@@ -1,22 +1,242 @@
+import json
+import logging
+import os
+import signal
 import subprocess
+import threading
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import suppress
 from functools import partial
-from typing import TYPE_CHECKING, Callable, Optional
+from pathlib import Path
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
-from packaging.version import Version
+from packaging.version import InvalidVersion, Version
 
-from ensureconda.installer import install_conda_exe, install_micromamba
 from ensureconda.resolve import (
-    conda_executables,
-    conda_standalone_executables,
-    mamba_executables,
-    micromamba_executables,
+    Candidate,
+    conda_candidates,
+    conda_standalone_candidates,
+    mamba_candidates,
+    micromamba_candidates,
+    site_path,
 )
 
 if TYPE_CHECKING:
     from _typeshed import StrPath
 
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+# Check that an executable has to pass; None accepts any without running it
+_Constraint = Optional[Callable[[Candidate], bool]]
+# A source of candidate executables along with the check they have to pass
+_Search = Tuple[Callable[[], Iterator[Candidate]], _Constraint]
+
+VERSION_CACHE_FILENAME = "version_cache.json"
+# Executables taking longer than this to report their version are ignored
+VERSION_PROBE_TIMEOUT_SEC = 30
+# Maximum number of candidate executables to probe concurrently
+MAX_PROBE_WORKERS = 8
+
+# Maps an executable path to its size, mtime and `--version` output.  This is
+# loaded lazily from `site_path()` and shared between threads.
+_version_cache: Optional[Dict[str, Dict[str, object]]] = None
+_version_cache_lock = threading.Lock()
+# The `_ProbeGroup` of the `_first_satisfying` call a daemon thread works for
+_probe_group = threading.local()
+
+
+def _version_cache_path() -> Path:
+    return site_path() / VERSION_CACHE_FILENAME
+
+
+def _load_version_cache() -> Dict[str, Dict[str, object]]:
+    global _version_cache
+    if _version_cache is None:
+        try:
+            with open(_version_cache_path(), encoding="utf-8") as f:
+                data = json.load(f)
+            _version_cache = data if isinstance(data, dict) else {}
+        except (OSError, ValueError):
+            _version_cache = {}
+    return _version_cache
+
+
+def _save_version_cache(cache: Dict[str, Dict[str, object]]) -> None:
+    """Write the version cache to disk, atomically replacing the previous one.
+
+    The cache is purely an optimization, so failing to write it is not an error.
+    """
+    cache_path = _version_cache_path()
+    temp_path = cache_path.with_name(uuid.uuid4().hex)
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+        os.replace(temp_path, cache_path)
+    except OSError:
+        with suppress(OSError):
+            os.unlink(temp_path)
+
+
+def _as_candidate(exe: "Union[StrPath, Candidate]") -> Candidate:
+    if isinstance(exe, Candidate):
+        return exe
+    return Candidate.from_path(exe)
+
+
+def _version_output(exe: "Union[StrPath, Candidate]") -> str:
+    """Return the output of `exe --version`, cached by path, mtime and size.
+
+    Running `--version` can take several seconds for conda and mamba, so the
+    result is remembered both in memory and on disk.  Replacing or modifying the
+    executable changes its mtime or size and hence invalidates the entry.
+
+    Passing a `Candidate` reuses its stat result instead of statting again.
+    """
+    candidate = _as_candidate(exe)
+    path = os.fspath(candidate.path)
+    st = candidate.st
+    cached = _cached_output(candidate)
+    if cached is not None:
+        logger.debug("Using cached version output for %s", path)
+        return cached
+
+    probes = getattr(_probe_group, "current", None)
+    proc = _start_probe(path) if probes is None else probes.start(path)
+    if proc is None:
+        # The result is no longer needed
+        return ""
+    try:
+        out, _ = proc.communicate(timeout=VERSION_PROBE_TIMEOUT_SEC)
+    except subprocess.TimeoutExpired:
+        # Treat a hanging executable as unusable, but don't remember that
+        logger.warning("Timed out determining the version of %s, ignoring it", path)
+        _kill_probe(proc)
+        proc.wait()
+        return ""
+    except BaseException:
+        _kill_probe(proc)
+        raise
+    finally:
+        if probes is not None:
+            probes.finished(proc)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, [path, "--version"], out)
+    out = out.strip()
+    logger.debug("%s --version reported %r", path, out)
+    with _version_cache_lock:
+        cache = _load_version_cache()
+        cache[path] = {"mtime_ns": st.st_mtime_ns, "size": st.st_size, "output": out}
+        if probes is None:
+            _save_version_cache(cache)
+        else:
+            probes.cache_changed = True
+    return out
+
+
+def _start_probe(path: str) -> "subprocess.Popen[str]":
+    return subprocess.Popen(
+        [path, "--version"],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        encoding="utf-8",
+        # Own process group, so that anything the executable starts is killed too
+        start_new_session=True,
+    )
+
+
+def _kill_probe(proc: "subprocess.Popen[str]") -> None:
+    with suppress(OSError):
+        if hasattr(os, "killpg"):
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+
+
+class _ProbeGroup:
+    """The `--version` probes run on behalf of a single `_first_satisfying` call.
+
+    Probes run in daemon threads, which simply stop when the interpreter exits.
+    So once the result is known, `close()` kills the probes that are still running
+    rather than leaving them behind as orphans, and writes new version cache
+    entries to disk from the calling thread, where it cannot be cut off halfway.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._running: Set["subprocess.Popen[str]"] = set()
+        self._closed = False
+        self.cache_changed = False
+
+    def start(self, path: str) -> "Optional[subprocess.Popen[str]]":
+        with self._lock:
+            if self._closed:
+                return None
+            proc = _start_probe(path)
+            self._running.add(proc)
+            return proc
+
+    def finished(self, proc: "subprocess.Popen[str]") -> None:
+        with self._lock:
+            self._running.discard(proc)
+
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+            running = list(self._running)
+        for proc in running:
+            _kill_probe(proc)
+        with _version_cache_lock:
+            if self.cache_changed:
+                _save_version_cache(_load_version_cache())
+
+
+def _cached_output(candidate: Candidate) -> Optional[str]:
+    """Return the cached output of `candidate --version` if it is still valid"""
+    with _version_cache_lock:
+        entry = _load_version_cache().get(os.fspath(candidate.path))
+    if (
+        entry is not None
+        and entry.get("mtime_ns") == candidate.st.st_mtime_ns
+        and entry.get("size") == candidate.st.st_size
+        and isinstance(entry.get("output"), str)
+    ):
+        return str(entry["output"])
+    return None
+
+
+def _version_from_conda_meta(exe: "StrPath", package: str) -> Optional[Version]:
+    """Look up the version of `package` in the conda prefix containing `exe`.
+
+    This reads the package records in `<prefix>/conda-meta`, which are named
+    `<name>-<version>-<build>.json`, and avoids running the executable at all.
+    """
+    prefix = Path(exe).resolve().parent.parent
+    for record in (prefix / "conda-meta").glob(f"{package}-*.json"):
+        parts = record.stem.rsplit("-", 2)
+        if len(parts) == 3 and parts[0] == package:
+            with suppress(InvalidVersion):
+                return Version(parts[1])
+    return None
+
 
-def determine_mamba_version(exe: "StrPath") -> Version:
+def determine_mamba_version(exe: "Union[StrPath, Candidate]") -> Version:
     """Determine the version of mamba on the given executable.
 
     Typical output of `mamba --version` for v1 is:
@@ -29,30 +249,141 @@ def determine_mamba_version(exe: "StrPath") -> Version:
     ```
     2.0.8
     ```
+
+    If mamba lives in a conda prefix, the version is taken from the installed
+    package record instead, since starting mamba v1 is particularly slow.
     """
-    out = subprocess.check_output([exe, "--version"], encoding="utf-8").strip()
+    candidate = _as_candidate(exe)
+    version = _version_from_conda_meta(candidate.path, "mamba")
+    if version is not None:
+        return version
+    out = _version_output(candidate)
     for line in out.splitlines(keepends=False):
         if line.startswith("mamba"):
             return Version(line.split()[-1])
     # Not v1 style output, so fall back to micromamba version detection
-    return determine_micromamba_version(exe)
+    return _parse_micromamba_version(out)
+
+
+def determine_micromamba_version(exe: "Union[StrPath, Candidate]") -> Version:
+    return _parse_micromamba_version(_version_output(exe))
 
 
-def determine_micromamba_version(exe: "StrPath") -> Version:
-    out = subprocess.check_output([exe, "--version"], encoding="utf-8").strip()
+def _parse_micromamba_version(out: str) -> Version:
     for line in out.splitlines(keepends=False):
         return Version(line.split()[-1])
     return Version("0.0.0")
 
 
-def determine_conda_version(exe: "StrPath") -> Version:
-    out = subprocess.check_output([exe, "--version"], encoding="utf-8").strip()
+def determine_conda_version(exe: "Union[StrPath, Candidate]") -> Version:
+    out = _version_output(exe)
     for line in out.splitlines(keepends=False):
         if line.startswith("conda"):
             return Version(line.split()[-1])
     return Version("0.0.0")
 
 
+def _run_in_background(fn: Callable[..., T], *args: Any) -> "Future[T]":
+    """Run `fn(*args)` in a daemon thread.
+
+    Unlike a `ThreadPoolExecutor`, the interpreter does not wait for the thread on
+    exit, so abandoned work, such as a slow `--version` probe of a candidate that is
+    no longer needed, never delays returning to the caller's shell.
+    """
+    future: "Future[T]" = Future()
+
+    def run() -> None:
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+def _first_satisfying(
+    candidates: Iterable[T],
+    predicate: Optional[Callable[[T], bool]],
+    max_workers: int = MAX_PROBE_WORKERS,
+) -> Optional[T]:
+    """Return the first candidate for which `predicate` holds.
+
+    If `predicate` is None, the first candidate is returned without consuming the
+    remaining ones.
+
+    The predicate is evaluated concurrently for all candidates since it is
+    typically a `--version` subprocess call.  This happens in daemon threads, at
+    most `max_workers` at a time, so that slow probes of later candidates don't
+    delay exiting; those still running once the result is known are killed.  The
+    result is the same as evaluating it serially: earlier candidates take precedence
+    and an exception is only raised if no earlier candidate satisfied the predicate.
+    """
+    if predicate is None:
+        return next((c for c in candidates if c), None)
+
+    items = [c for c in candidates if c]
+    if len(items) <= 1:
+        return next((c for c in items if predicate(c)), None)
+
+    slots = threading.BoundedSemaphore(max_workers)
+    done = threading.Event()
+    probes = _ProbeGroup()
+
+    def evaluate(candidate: T) -> bool:
+        _probe_group.current = probes
+        with slots:
+            # Don't start new probes once the result is known
+            return not done.is_set() and predicate(candidate)
+
+    futures = [_run_in_background(evaluate, c) for c in items]
+    try:
+        for candidate, future in zip(items, futures):
+            if future.result():
+                return candidate
+        return None
+    finally:
+        done.set()
+        probes.close()
+
+
+def _prefetch(searches: List[_Search]) -> List[_Search]:
+    """Enumerate the candidates of all searches up front, concurrently.
+
+    Walking $PATH (and the registry on Windows) is mostly waiting on `stat`, so the
+    enumerations overlap well in threads.
+    """
+    enumerators = [candidates for candidates, _ in searches]
+    if len(enumerators) <= 1:
+        found = [_collect(candidates) for candidates in enumerators]
+    else:
+        with ThreadPoolExecutor(max_workers=len(enumerators)) as executor:
+            found = list(executor.map(_collect, enumerators))
+    return [
+        (partial(iter, candidates), constraint)
+        for candidates, (_, constraint) in zip(found, searches)
+    ]
+
+
+def _collect(candidates: Callable[[], Iterator[Candidate]]) -> List[Candidate]:
+    # Executables may be resolved more than once, e.g. via site_path() and $PATH
+    found: Dict[Path, Candidate] = {}
+    for candidate in candidates():
+        found.setdefault(candidate.path, candidate)
+    return list(found.values())
+
+
+def _first_found(searches: Iterable[_Search]) -> Optional[Path]:
+    """Return the first executable satisfying its constraints across all searches"""
+    for candidates, constraints_met in searches:
+        candidate = _first_satisfying(candidates(), constraints_met)
+        if candidate is not None:
+            return candidate.path
+    return None
+
+
 def ensureconda(
     *,
     mamba: bool = True,
@@ -76,6 +407,9 @@ def ensureconda(
         Allow resolving conda.
     conda_exe
         Allow resolving conda-standalong
+    no_install:
+        Only search for existing executables.  Otherwise, if no suitable executable
+        is found, install micromamba and/or conda-standalone as allowed above.
     min_conda_version:
         Minimum version of conda required
     min_mamba_version:
@@ -85,50 +419,70 @@ def ensureconda(
     """
 
     def version_constraint_met(
-        executable: "StrPath",
-        min_version: Optional[Version],
-        version_fn: Callable[["StrPath"], Version],
+        executable: Candidate,
+        min_version: Version,
+        version_fn: Callable[[Candidate], Version],
     ) -> bool:
-        return (min_version is None) or (version_fn(executable) >= min_version)
+        version = version_fn(executable)
+        logger.debug("Found %s with version %s", executable.path, version)
+        return version >= min_version
 
-    conda_constraints_met = partial(
-        version_constraint_met,
-        min_version=min_conda_version,
-        version_fn=determine_conda_version,
-    )
-    mamba_constraints_met = partial(
-        version_constraint_met,
-        min_version=min_mamba_version,
-        version_fn=determine_mamba_version,
-    )
-    micromamba_constraints_met = partial(
-        version_constraint_met,
-        min_version=min_mamba_version,
-        version_fn=determine_micromamba_version,
+    def constraint(
+        min_version: Optional[Version], version_fn: Callable[[Candidate], Version]
+    ) -> _Constraint:
+        # Without a minimum version there is no need to run the executable at all
+        if min_version is None:
+            return None
+        return partial(
+            version_constraint_met, min_version=min_version, version_fn=version_fn
+        )
+
+    conda_constraints_met = constraint(min_conda_version, determine_conda_version)
+    mamba_constraints_met = constraint(min_mamba_version, determine_mamba_version)
+    micromamba_constraints_met = constraint(
+        min_mamba_version, determine_micromamba_version
     )
 
+    mamba_searches: List[_Search] = []
     if mamba:
-        for exe in mamba_executables():
-            if exe and mamba_constraints_met(exe):
-                return exe
+        mamba_searches.append((mamba_candidates, mamba_constraints_met))
     if micromamba:
-        for exe in micromamba_executables():
-            if exe and micromamba_constraints_met(exe):
-                return exe
-        if not no_install:
-            maybe_exe = install_micromamba()
-            if maybe_exe is not None and micromamba_constraints_met(maybe_exe):
-                return maybe_exe
+        mamba_searches.append((micromamba_candidates, micromamba_constraints_met))
+    conda_searches: List[_Search] = []
     if conda:
-        for exe in conda_executables():
-            if exe and conda_constraints_met(exe):
-                return exe
+        conda_searches.append((conda_candidates, conda_constraints_met))
+    if conda_exe:
+        conda_searches.append((conda_standalone_candidates, conda_constraints_met))
+
+    n_mamba = len(mamba_searches)
+    prefetched = _prefetch(mamba_searches + conda_searches)
+    mamba_searches, conda_searches = prefetched[:n_mamba], prefetched[n_mamba:]
+
+    # Prefer any suitable executable that is already present over installing one
+    exe = _first_found(mamba_searches)
+    if exe is not None:
+        return exe
+
+    exe = _first_found(conda_searches)
+    if exe is not None:
+        return exe
+
+    if no_install:
+        return None
+
+    # Deferred since the installer pulls in requests and friends, which are slow
+    # to import and not needed when a conda is already present
+    from ensureconda.installer import install_conda_exe, install_micromamba
+
+    installs: List[Tuple[Callable[[], Optional[Path]], _Constraint]] = []
+    if micromamba:
+        installs.append((install_micromamba, micromamba_constraints_met))
     if conda_exe:
-        for exe in conda_standalone_executables():
-            if exe and conda_constraints_met(exe):
-                return exe
-        if not no_install:
-            maybe_exe = install_conda_exe()
-            if maybe_exe is not None and conda_constraints_met(maybe_exe):
-                return maybe_exe
+        installs.append((install_conda_exe, conda_constraints_met))
+    for install, constraints_met in installs:
+        maybe_exe = install()
+        if maybe_exe is not None and (
+            constraints_met is None or constraints_met(Candidate.from_path(maybe_exe))
+        ):
+            return maybe_exe
     return None
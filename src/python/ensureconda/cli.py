@@ -1,14 +1,14 @@
+import logging
 import sys
-import time
 from typing import Any, Optional, Union
 
 import click
-from packaging.version import Version
+from packaging.version import InvalidVersion, Version
 
 from ensureconda.api import ensureconda
 
 
-def _as_loose_version(obj: Union[str, Version, None]) -> Version:
+def _as_version(obj: Union[str, Version, None]) -> Version:
     if isinstance(obj, Version):
         return obj
     elif obj is None:
@@ -17,8 +17,16 @@ def _as_loose_version(obj: Union[str, Version, None]) -> Version:
         return Version(obj)
 
 
-_DEFAULT_MIN_CONDA = "4.8.2"
-_DEFAULT_MIN_MAMBA = "0.7.3"
+_DEFAULT_MIN_CONDA = Version("4.8.2")
+_DEFAULT_MIN_MAMBA = Version("0.7.3")
+
+# Same levels as the golang implementation, which also has a trace level
+_LOG_LEVELS = {
+    0: logging.WARNING,
+    1: logging.INFO,
+    2: logging.DEBUG,
+    3: logging.DEBUG,
+}
 
 
 class VersionNumber(click.ParamType):
@@ -27,7 +35,10 @@ class VersionNumber(click.ParamType):
     def convert(
         self, value: Union[str, Version, None], param: Any, ctx: Any
     ) -> Version:
-        return _as_loose_version(value)
+        try:
+            return _as_version(value)
+        except InvalidVersion:
+            self.fail(f"{value!r} is not a valid version number", param, ctx)
 
 
 @click.command(help="Ensures that a conda/mamba is installed.")
@@ -50,16 +61,23 @@ class VersionNumber(click.ParamType):
 )
 @click.option(
     "--min-conda-version",
-    default=Version(_DEFAULT_MIN_CONDA),
+    default=_DEFAULT_MIN_CONDA,
     type=VersionNumber(),
     help=f"minimum version of conda to accept (defaults to {_DEFAULT_MIN_CONDA})",
 )
 @click.option(
     "--min-mamba-version",
-    default=Version(_DEFAULT_MIN_MAMBA),
+    default=_DEFAULT_MIN_MAMBA,
     type=VersionNumber(),
     help=f"minimum version of mamba/micromamba to accept (defaults to {_DEFAULT_MIN_MAMBA})",
 )
+@click.option(
+    "-v",
+    "--verbosity",
+    default=1,
+    type=click.IntRange(0, 3),
+    help="verbosity level (0-3)",
+)
 def ensureconda_cli(
     mamba: bool,
     micromamba: bool,
@@ -68,32 +86,24 @@ def ensureconda_cli(
     no_install: bool,
     min_conda_version: Optional[Version],
     min_mamba_version: Optional[Version],
+    verbosity: int,
 ) -> None:
-    # We run the loop twice, once to find all the eligible condas without installation
-    # and once if you haven't found anything after installation
+    # Logs go to stderr, since stdout is reserved for the path of the executable
+    logging.basicConfig(
+        level=_LOG_LEVELS[verbosity], stream=sys.stderr, format="%(message)s"
+    )
     exe = ensureconda(
         mamba=mamba,
         micromamba=micromamba,
         conda=conda,
         conda_exe=conda_exe,
-        no_install=True,
+        no_install=no_install,
         min_mamba_version=min_mamba_version,
         min_conda_version=min_conda_version,
     )
-    if not exe and not no_install:
-        exe = ensureconda(
-            mamba=mamba,
-            micromamba=micromamba,
-            conda=conda,
-            conda_exe=conda_exe,
-            no_install=False,
-            min_mamba_version=min_mamba_version,
-            min_conda_version=min_conda_version,
-        )
     if exe:
+        # Both streams are flushed immediately, so the writes reach the OS in order
         print("Found compatible executable", file=sys.stderr, flush=True)
-        # silly thing to force correct output order
-        time.sleep(0.01)
         print(str(exe), flush=True)
         sys.exit(0)
     else:
@@ -1,21 +1,39 @@
 import contextlib
-import io
-import math
+import json
 import os
-import stat
+import random
+import shutil
 import sys
 import tarfile
 import time
 import uuid
 from contextlib import closing
+from functools import lru_cache
+from itertools import takewhile
 from pathlib import Path
-from typing import IO, Any, Dict, Iterator, List, NamedTuple, Optional, Union
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+    cast,
+)
 
 import filelock
 import requests
+import urllib3
 from conda_package_streaming.package_streaming import stream_conda_component
 from conda_package_streaming.url import conda_reader_for_url
 from packaging.version import Version
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from ensureconda.resolve import is_windows, platform_subdir, site_path
 
@@ -25,6 +43,29 @@ REDOWNLOAD_WHEN_OLDER_THAN_SEC = 60 * 60 * 24  # 1 day
 NEGATIVE_AGE_TOLERANCE_SEC = -60
 # Interval to notify users about waiting for lock and timeout for lock acquisition
 LOCK_NOTIFICATION_INTERVAL_SEC = 5
+# Number of retries for failed downloads; the n-th retry waits about
+# HTTP_BACKOFF_FACTOR * 2 ** (n - 1) seconds
+HTTP_RETRIES = 6
+HTTP_BACKOFF_FACTOR = 0.5
+# Timeout for connecting to and reading from the download servers
+HTTP_TIMEOUT_SEC = 30
+# Chunk size for copying executables out of their archives
+COPY_BUFFER_SIZE = 1 << 20  # 1 MiB
+# Location of the executable within the conda-standalone package
+CONDA_EXE_MEMBER = "standalone_conda/conda.exe"
+# Permissions of installed executables
+EXECUTABLE_MODE = 0o755
+
+T = TypeVar("T")
+
+# Errors raised when the connection breaks while a response body is being read.
+# The session's Retry only covers getting the response, not consuming it.
+_INTERRUPTED_BODY_ERRORS = (
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.ConnectionError,
+    urllib3.exceptions.ProtocolError,
+    urllib3.exceptions.ReadTimeoutError,
+)
 
 
 class AnacondaPkgAttr(NamedTuple):
@@ -50,53 +91,128 @@ class AnacondaPkg(NamedTuple):
     download_url: str
 
 
-def request_url_with_retry(url: str) -> requests.Response:
-    n = 10
-    for i in range(n):
-        try:
-            resp = requests.get(url, allow_redirects=True)
-        except requests.exceptions.RequestException as e:
-            timeout = max(math.e ** (i / 4), 15)
-            print(
-                f"Failed to retrieve due to {e!r}, retrying in {timeout:.2f} seconds",
-                file=sys.stderr,
+def _retry_backoff_time(retry_number: int) -> float:
+    """Seconds to wait before the `retry_number`-th retry, counting from 1.
+
+    Exponential backoff with a little jitter, so that many CI jobs hitting the same
+    server don't all retry in lockstep.
+    """
+    backoff = HTTP_BACKOFF_FACTOR * 2.0 ** (retry_number - 1)
+    return backoff + random.uniform(0, 0.25 * backoff)
+
+
+class _JitteredRetry(Retry):
+    """Retry policy of the session, backing off with `_retry_backoff_time`"""
+
+    def get_backoff_time(self) -> float:
+        # Like urllib3, only count the errors since the last redirect
+        consecutive_errors = len(
+            list(
+                takewhile(lambda h: h.redirect_location is None, reversed(self.history))
             )
-            time.sleep(timeout)
-            continue
-        try:
-            resp.raise_for_status()
-            return resp
-        except requests.exceptions.HTTPError as e:
-            if e.response.status_code in [500, 503]:
-                timeout = max(math.e ** (i / 4), 15)
+        )
+        if consecutive_errors == 0:
+            return 0
+        return _retry_backoff_time(consecutive_errors)
+
+
+@lru_cache(maxsize=None)
+def get_session() -> requests.Session:
+    """Shared session so that connections are reused between downloads"""
+    retry = _JitteredRetry(
+        total=HTTP_RETRIES,
+        backoff_factor=HTTP_BACKOFF_FACTOR,
+        status_forcelist=[500, 502, 503, 504],
+        allowed_methods=["GET"],
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    session = requests.Session()
+    adapter = HTTPAdapter(max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def request_url_with_retry(
+    url: str, stream: bool = False, headers: Optional[Dict[str, str]] = None
+) -> requests.Response:
+    """GET the url, retrying on connection errors and transient server errors."""
+    resp = get_session().get(
+        url,
+        allow_redirects=True,
+        stream=stream,
+        headers=headers,
+        timeout=HTTP_TIMEOUT_SEC,
+    )
+    resp.raise_for_status()
+    return resp
+
+
+def read_url_with_retry(
+    url: str,
+    read: Callable[[requests.Response], T],
+    headers: Optional[Dict[str, str]] = None,
+) -> T:
+    """GET the url and return `read(response)`.
+
+    The body is streamed, and if the connection breaks while `read` consumes it, the
+    whole request is repeated with the same backoff as for failed requests.
+    """
+    attempt = 0
+    while True:
+        resp = request_url_with_retry(url, stream=True, headers=headers)
+        with closing(resp):
+            try:
+                return read(resp)
+            except _INTERRUPTED_BODY_ERRORS as e:
+                if attempt >= HTTP_RETRIES:
+                    raise
+                delay = _retry_backoff_time(attempt + 1)
                 print(
-                    f"Failed to retrieve due to {e!r}, "
-                    f"retrying in {timeout:.2f} seconds",
+                    f"Download from {url} was interrupted ({e}), "
+                    f"retrying in {delay:.1f}s",
                     file=sys.stderr,
                 )
-                time.sleep(timeout)
-            else:
-                raise
-
-    raise TimeoutError(f"Could not retrieve {url} in {n} tries")
+        attempt += 1
+        time.sleep(delay)
 
 
 def extract_files_from_tar_bz2(
-    tarball: io.BytesIO, filename: str, dest_filename: str
+    tarball: IO[bytes], filename: str, dest_filename: str
 ) -> Path:
-    tarball.seek(0)
-    with tarfile.open(mode="r:bz2", fileobj=tarball) as tf:
-        fo = tf.extractfile(filename)
-        if fo is None:
-            raise RuntimeError("Could not extract executable!")
-        return write_executable_from_file_object(fo, dest_filename)
+    """Extract a single file from a (possibly non-seekable) `.tar.bz2` stream.
+
+    The archive is read in a single pass, stopping as soon as `filename` has been
+    written, so the tarball never needs to be held in memory.
+    """
+    with tarfile.open(mode="r|bz2", fileobj=tarball) as tf:
+        for member in tf:
+            if member.name == filename:
+                fo = tf.extractfile(member)
+                if fo is None:
+                    raise RuntimeError("Could not extract executable!")
+                return write_executable_from_file_object(
+                    fo, dest_filename, size=member.size
+                )
+    raise RuntimeError(f"Could not find {filename} in the tarball!")
 
 
-def write_executable_from_file_object(fo: IO[bytes], dest_filename: str) -> Path:
+def write_executable_from_file_object(
+    fo: IO[bytes], dest_filename: str, size: Optional[int] = None
+) -> Path:
+    """Copy `fo` into a new executable in chunks.
+
+    If the final `size` is known, the file is preallocated where supported.
+    """
     site_path().mkdir(parents=True, exist_ok=True)
     target_path = site_path() / dest_filename
     with new_executable(target_path) as exe_fo:
-        exe_fo.write(fo.read())
+        if size and hasattr(os, "posix_fallocate"):
+            # Not supported by every filesystem, and only an optimization
+            with contextlib.suppress(OSError):
+                os.posix_fallocate(exe_fo.fileno(), 0, size)
+        shutil.copyfileobj(fo, exe_fo, COPY_BUFFER_SIZE)
     return target_path
 
 
@@ -149,17 +265,23 @@ def stream_conda_executable(url: str) -> Path:
     """
     dest_filename = f"conda_standalone{exe_suffix()}"
 
-    filename, conda = conda_reader_for_url(url)
+    filename, conda = conda_reader_for_url(url, session=get_session())
     with closing(conda):
-        for tar, member in stream_conda_component(filename, conda, component="pkg"):
-            if member.name == "standalone_conda/conda.exe":
-                fo = tar.extractfile(member)
-                if fo is None:
-                    raise RuntimeError(
-                        f"Could not extract executable {member.name} from {url}!"
+        members = stream_conda_component(filename, conda, component="pkg")
+        # Stop decompressing as soon as conda.exe has been written, rather than
+        # whenever the abandoned generator happens to be garbage collected
+        with closing(members):
+            for tar, member in members:
+                if member.name == CONDA_EXE_MEMBER:
+                    fo = tar.extractfile(member)
+                    if fo is None:
+                        raise RuntimeError(
+                            f"Could not extract executable {member.name} from {url}!"
+                        )
+                    conda_exe = write_executable_from_file_object(
+                        fo, dest_filename, size=member.size
                     )
-                conda_exe = write_executable_from_file_object(fo, dest_filename)
-                return conda_exe
+                    return conda_exe
         raise RuntimeError("Could not find conda.exe in the conda-standalone package")
 
 
@@ -197,26 +319,38 @@ def install_conda_exe() -> Optional[Path]:
 
         channel = get_channel_name()
         candidates = compute_candidates(channel, platform_subdir())
-        chosen = candidates[-1]
+        chosen = max(candidates, key=candidate_sort_key)
         url = "https:" + chosen.download_url
         path_to_written_executable = stream_conda_executable(url)
         return path_to_written_executable
 
 
 def compute_candidates(channel: str, subdir: str) -> List[AnacondaPkg]:
-    """Compute the candidates for the conda-standalone package"""
+    """Compute the candidates for the conda-standalone package
+
+    The candidates are returned in API order; use `candidate_sort_key` to rank them.
+    """
 
     url = f"https://api.anaconda.org/package/{channel}/conda-standalone/files"
-    resp = request_url_with_retry(url)
-    api_response_data: List[Dict[str, Any]] = resp.json()
+    api_response_data: List[Dict[str, Any]] = read_url_with_retry(
+        url, lambda resp: resp.json()
+    )
 
     candidates = []
     for file_info in api_response_data:
+        file_attrs = file_info["attrs"]
+        if (
+            file_attrs["subdir"] != subdir
+            # Ignore onedir packages as workaround for
+            # <https://github.com/conda/conda-standalone/issues/182>
+            or "_onedir_" in file_attrs["build"]
+        ):
+            continue
         info_attrs = AnacondaPkgAttr(
-            subdir=file_info["attrs"]["subdir"],
-            build=file_info["attrs"]["build"],
-            build_number=file_info["attrs"]["build_number"],
-            timestamp=file_info["attrs"]["timestamp"],
+            subdir=file_attrs["subdir"],
+            build=file_attrs["build"],
+            build_number=file_attrs["build_number"],
+            timestamp=file_attrs["timestamp"],
         )
         info = AnacondaPkg(
             size=file_info["size"],
@@ -225,27 +359,22 @@ def compute_candidates(channel: str, subdir: str) -> List[AnacondaPkg]:
             version=file_info["version"],
             download_url=file_info["download_url"],
         )
-        if (
-            info.attrs.subdir == subdir
-            and
-            # Ignore onedir packages as workaround for
-            # <https://github.com/conda/conda-standalone/issues/182>
-            "_onedir_" not in info.attrs.build
-        ):
-            candidates.append(info)
+        candidates.append(info)
 
-    candidates.sort(
-        key=lambda attrs: (
-            Version(attrs.version),
-            attrs.attrs.build_number,
-            attrs.attrs.timestamp,
-        )
-    )
     if len(candidates) == 0:
         raise RuntimeError(f"No conda-standalone package found for {subdir}")
     return candidates
 
 
+# Many builds share a version string, so only parse each distinct one once
+_parse_version = lru_cache(maxsize=None)(Version)
+
+
+def candidate_sort_key(pkg: AnacondaPkg) -> Tuple[Version, int, int]:
+    """Order conda-standalone packages from oldest to newest"""
+    return _parse_version(pkg.version), pkg.attrs.build_number, pkg.attrs.timestamp
+
+
 def install_micromamba() -> Optional[Path]:
     """Install micromamba into the installation"""
     # Create a lock file specific to micromamba to prevent concurrent downloads
@@ -270,17 +399,66 @@ def install_micromamba() -> Optional[Path]:
 
         subdir = platform_subdir()
         url = f"https://micro.mamba.pm/api/micromamba/{subdir}/latest"
-        resp = request_url_with_retry(url)
-
-        tarball = io.BytesIO(resp.content)
         if is_windows:
             filename = "Library/bin/micromamba.exe"
         else:
             filename = "bin/micromamba"
 
-    return extract_files_from_tar_bz2(
-        tarball=tarball, filename=filename, dest_filename=f"micromamba{exe_suffix()}"
-    )
+        # Only download if the latest micromamba differs from the one we have
+        validators_path = target_path.with_name(f".{dest_filename}.etag")
+        headers = {}
+        if target_path.exists():
+            headers = conditional_request_headers(validators_path)
+
+        def extract(resp: requests.Response) -> Path:
+            if resp.status_code == 304:
+                # Still current, so mark it as fresh again
+                os.utime(target_path)
+                return target_path
+            # Undo any transfer encoding; the bz2 layer is handled by tarfile
+            resp.raw.decode_content = True
+            tarball = cast(IO[bytes], resp.raw)
+            micromamba_exe = extract_files_from_tar_bz2(
+                tarball=tarball,
+                filename=filename,
+                dest_filename=dest_filename,
+            )
+            save_response_validators(resp, validators_path)
+            return micromamba_exe
+
+        return read_url_with_retry(url, extract, headers=headers)
+
+
+def conditional_request_headers(validators_path: Path) -> Dict[str, str]:
+    """Headers for a conditional GET based on previously saved validators"""
+    try:
+        with open(validators_path, encoding="utf-8") as f:
+            validators = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    headers = {}
+    if isinstance(validators.get("etag"), str):
+        headers["If-None-Match"] = validators["etag"]
+    if isinstance(validators.get("last_modified"), str):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+
+def save_response_validators(resp: requests.Response, validators_path: Path) -> None:
+    """Save the ETag and Last-Modified headers of `resp` for conditional GETs"""
+    validators = {
+        "etag": resp.headers.get("ETag"),
+        "last_modified": resp.headers.get("Last-Modified"),
+    }
+    temp_path = validators_path.with_name(uuid.uuid4().hex)
+    try:
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(validators, f)
+        os.replace(temp_path, validators_path)
+    except OSError:
+        # Without validators we simply download again next time
+        with contextlib.suppress(OSError):
+            os.unlink(temp_path)
 
 
 def exe_suffix() -> str:
@@ -297,17 +475,25 @@ def new_executable(target_filename: "Path") -> Iterator[IO[bytes]]:
     lock_path = f"{str(target_filename)}.lock"
     with lock_with_feedback(lock_path, f"file write ({target_filename})"):
         temp_filename = target_filename.with_name(uuid.uuid4().hex)
-        with open(temp_filename, "wb") as fo:
-            yield fo
-        st = os.stat(temp_filename)
-        os.chmod(temp_filename, st.st_mode | stat.S_IXUSR)
-        # On Windows, we need to handle the case where the target file already exists
-        if sys.platform in ["win32", "cygwin", "msys"] and target_filename.exists():
-            try:
-                target_filename.unlink()
-            except (PermissionError, OSError) as e:
-                raise RuntimeError(
-                    f"Could not remove existing executable {target_filename} "
-                    f"for replacement"
-                ) from e
-        os.rename(temp_filename, target_filename)
+        try:
+            with open(temp_filename, "wb") as fo:
+                yield fo
+                # Mark as executable before the file appears under its final name
+                if hasattr(os, "fchmod"):
+                    os.fchmod(fo.fileno(), EXECUTABLE_MODE)
+            if not hasattr(os, "fchmod"):
+                os.chmod(temp_filename, EXECUTABLE_MODE)
+        except BaseException:
+            # Don't leave incomplete executables lying around
+            with contextlib.suppress(OSError):
+                os.unlink(temp_filename)
+            raise
+        # os.replace atomically overwrites an existing target, also on Windows
+        try:
+            os.replace(temp_filename, target_filename)
+        except PermissionError as e:
+            with contextlib.suppress(OSError):
+                os.unlink(temp_filename)
+            raise RuntimeError(
+                f"Could not replace existing executable {target_filename}"
+            ) from e
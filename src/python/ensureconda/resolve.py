@@ -2,12 +2,17 @@ import os
 import pathlib
 import platform
 import shutil
+import stat
 import sys
+from functools import lru_cache
 from pathlib import Path
-from typing import TYPE_CHECKING, Iterator, Optional, TypeVar
+from typing import TYPE_CHECKING, Iterator, NamedTuple, Optional, TypeVar
 
 import appdirs
 
+if TYPE_CHECKING:
+    from _typeshed import StrPath
+
 
 def ext_candidates(fpath: str) -> Iterator[str]:
     if is_windows:
@@ -18,10 +23,35 @@ def ext_candidates(fpath: str) -> Iterator[str]:
         yield fpath + ext
 
 
-def is_exe(fpath: Optional[Path]) -> bool:
+class Candidate(NamedTuple):
+    """A candidate executable along with the result of `os.stat` on it
+
+    Keeping the stat result around saves statting the same file again later.
+    """
+
+    path: Path
+    st: os.stat_result
+
+    @classmethod
+    def from_path(cls, path: "StrPath") -> "Candidate":
+        return cls(Path(path), os.stat(path))
+
+
+def stat_exe(fpath: Optional[Path]) -> Optional[os.stat_result]:
+    """Stat `fpath` if it is an executable file, otherwise return None"""
     if fpath is None:
-        return False
-    return os.path.exists(fpath) and os.access(fpath, os.X_OK) and os.path.isfile(fpath)
+        return None
+    try:
+        st = os.stat(fpath)
+    except OSError:
+        return None
+    if stat.S_ISREG(st.st_mode) and os.access(fpath, os.X_OK):
+        return st
+    return None
+
+
+def is_exe(fpath: Optional[Path]) -> bool:
+    return stat_exe(fpath) is not None
 
 
 def which_no_shims(executable: str) -> Optional[str]:
@@ -41,44 +71,73 @@ def which_no_shims(executable: str) -> Optional[str]:
     return shutil.which(executable, path=os.pathsep.join(path_list))
 
 
+@lru_cache(maxsize=None)
 def site_path() -> pathlib.Path:
     return pathlib.Path(appdirs.user_data_dir("ensure-conda"))
 
 
-def resolve_executable(exe_name: str) -> Iterator[Path]:
+def resolve_candidates(exe_name: str) -> Iterator[Candidate]:
     path_prefix = site_path()
     for candidate in ext_candidates(exe_name):
         if path_prefix is not None:
             prefixed_exe = path_prefix / candidate
-            if is_exe(prefixed_exe):
-                yield prefixed_exe
+            st = stat_exe(prefixed_exe)
+            if st is not None:
+                yield Candidate(prefixed_exe, st)
 
         # which based exe
         exe = which_no_shims(candidate)
         if exe:
             exe_path = pathlib.Path(exe)
-            if is_exe(exe_path):
-                yield exe_path
+            st = stat_exe(exe_path)
+            if st is not None:
+                yield Candidate(exe_path, st)
 
 
-def conda_executables() -> Iterator[Path]:
+def resolve_executable(exe_name: str) -> Iterator[Path]:
+    for candidate in resolve_candidates(exe_name):
+        yield candidate.path
+
+
+def conda_candidates() -> Iterator[Candidate]:
     conda_exe_from_env = os.environ.get("CONDA_EXE")
     if conda_exe_from_env:
-        if is_exe(Path(conda_exe_from_env)):
-            yield Path(conda_exe_from_env)
-    yield from resolve_executable("conda")
+        st = stat_exe(Path(conda_exe_from_env))
+        if st is not None:
+            yield Candidate(Path(conda_exe_from_env), st)
+    yield from resolve_candidates("conda")
+
+
+def conda_standalone_candidates() -> Iterator[Candidate]:
+    yield from resolve_candidates("conda_standalone")
+
+
+def mamba_candidates() -> Iterator[Candidate]:
+    yield from resolve_candidates("mamba")
+
+
+def micromamba_candidates() -> Iterator[Candidate]:
+    yield from resolve_candidates("micromamba")
+
+
+def conda_executables() -> Iterator[Path]:
+    for candidate in conda_candidates():
+        yield candidate.path
 
 
 def conda_standalone_executables() -> Iterator[Path]:
-    yield from resolve_executable("conda_standalone")
+    for candidate in conda_standalone_candidates():
+        yield candidate.path
 
 
 def mamba_executables() -> Iterator[Path]:
-    yield from resolve_executable("mamba")
+    for candidate in mamba_candidates():
+        yield candidate.path
 
 
 def micromamba_executables() -> Iterator[Path]:
-    yield from resolve_executable("micromamba")
+    for candidate in micromamba_candidates():
+        yield candidate.path
 
 
 T = TypeVar("T")
@@ -91,6 +150,7 @@ def safe_next(it: Iterator[T]) -> Optional[T]:
         return None
 
 
+@lru_cache(maxsize=None)
 def platform_subdir() -> str:
     # Adapted from conda.context
     _platform_map = {
@@ -1,6 +1,6 @@
 import os
 import sys
-from typing import Optional
+from typing import Iterator, Optional
 
 import docker
 import pytest
@@ -30,3 +30,13 @@ def docker_client(can_i_docker: bool) -> Optional[docker.client.DockerClient]:
     if can_i_docker:
         return docker.from_env()
     return None
+
+
+@pytest.fixture(autouse=True)
+def clear_site_path_cache() -> Iterator[None]:
+    """Tests monkeypatch `appdirs` to install into a temporary directory"""
+    from ensureconda.resolve import site_path
+
+    site_path.cache_clear()
+    yield
+    site_path.cache_clear()
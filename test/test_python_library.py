@@ -1,7 +1,11 @@
 import concurrent.futures
+import io
+import json
 import os
 import pathlib
 import subprocess
+import sys
+import tarfile
 import time
 from test.helpers import run_container_test
 from typing import TYPE_CHECKING, Any, Dict, List, Literal, Optional
@@ -9,6 +13,7 @@ from typing import TYPE_CHECKING, Any, Dict, List, Literal, Optional
 import docker
 import docker.models.images
 import pytest
+from packaging.version import Version
 
 if TYPE_CHECKING:
     from _typeshed import StrPath
@@ -284,3 +289,369 @@ def test_concurrent_access(
     assert str(executables[0]).endswith(f"conda_standalone{ext}")
 
     print(f"Concurrent execution completed in {end_time - start_time:.2f} seconds")
+
+
+@pytest.mark.skipif(os.name == "nt", reason="requires a POSIX shell script")
+def test_version_cache(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    import appdirs
+
+    from ensureconda import api
+
+    site = tmp_path / "site"
+    monkeypatch.setattr(appdirs, "user_data_dir", lambda *a, **kw: str(site))
+    monkeypatch.setattr(api, "_version_cache", None)
+
+    counter = tmp_path / "calls"
+    exe = tmp_path / "conda"
+    exe.write_text(f'#!/bin/sh\necho x >> "{counter}"\necho "conda 4.9.0"\n')
+    exe.chmod(0o755)
+
+    def calls() -> int:
+        return len(counter.read_text().splitlines())
+
+    assert api.determine_conda_version(exe) == Version("4.9.0")
+    assert api.determine_conda_version(exe) == Version("4.9.0")
+    assert calls() == 1
+
+    # The on-disk cache is used by a fresh process
+    monkeypatch.setattr(api, "_version_cache", None)
+    assert api.determine_conda_version(exe) == Version("4.9.0")
+    assert calls() == 1
+    assert (site / api.VERSION_CACHE_FILENAME).exists()
+
+    # Changing the executable invalidates the entry
+    exe.write_text(f'#!/bin/sh\necho x >> "{counter}"\necho "conda 23.1.0"\n')
+    assert api.determine_conda_version(exe) == Version("23.1.0")
+    assert calls() == 2
+
+
+def test_first_satisfying_prefers_earliest_candidate() -> None:
+    from ensureconda.api import _first_satisfying
+
+    def predicate(n: int) -> bool:
+        # Make the earliest satisfying candidate the slowest to finish
+        time.sleep(0.05 if n == 2 else 0)
+        if n == 7:
+            raise RuntimeError("broken candidate")
+        return n % 2 == 0
+
+    assert _first_satisfying([2, 3, 4, 6], predicate) == 2
+    assert _first_satisfying([1, 3, 5], predicate) is None
+    assert _first_satisfying([], predicate) is None
+    assert _first_satisfying([3, 7], None) == 3
+    assert _first_satisfying([2, 7], predicate) == 2
+    with pytest.raises(RuntimeError):
+        _first_satisfying([1, 7, 2], predicate)
+
+
+def test_first_satisfying_does_not_wait_for_slow_candidates() -> None:
+    """Remaining probes must not keep the interpreter from exiting"""
+    script = """if True:
+        import time
+        from ensureconda.api import _first_satisfying
+
+        def predicate(n):
+            time.sleep(0 if n == 1 else 30)
+            return True
+
+        assert _first_satisfying([1, 2, 3], predicate) == 1
+    """
+    start = time.time()
+    subprocess.check_call([sys.executable, "-c", script])
+    assert time.time() - start < 15
+
+
+@pytest.mark.skipif(os.name == "nt", reason="requires a POSIX shell script")
+def test_first_satisfying_kills_abandoned_probes(tmp_path: pathlib.Path) -> None:
+    """Probes still running when the result is known must not outlive the caller"""
+    pid_file = tmp_path / "sleep.pid"
+    fast = tmp_path / "fast" / "conda"
+    slow = tmp_path / "slow" / "conda"
+    for exe, body in [
+        # Only answer once the slow probe is under way
+        (fast, f'while [ ! -s "{pid_file}" ]; do sleep 0.05; done\necho "conda 4.9.0"'),
+        (slow, f'sleep 45 &\necho $! > "{pid_file}"\nwait'),
+    ]:
+        exe.parent.mkdir()
+        exe.write_text(f"#!/bin/sh\n{body}\n")
+        exe.chmod(0o755)
+    site = tmp_path / "site"
+    script = f"""if True:
+        import appdirs
+        from packaging.version import Version
+        from ensureconda.api import _first_satisfying, determine_conda_version
+
+        appdirs.user_data_dir = lambda *a, **kw: {str(site)!r}
+        found = _first_satisfying(
+            [{str(fast)!r}, {str(slow)!r}],
+            lambda exe: determine_conda_version(exe) >= Version("4.8.2"),
+        )
+        assert found == {str(fast)!r}
+    """
+    subprocess.check_call([sys.executable, "-c", script], timeout=30)
+
+    def alive(pid: str) -> bool:
+        stat = subprocess.run(
+            ["ps", "-o", "stat=", "-p", pid], stdout=subprocess.PIPE, text=True
+        ).stdout.strip()
+        return bool(stat) and not stat.startswith("Z")
+
+    pid = pid_file.read_text().strip()
+    deadline = time.time() + 5
+    while alive(pid) and time.time() < deadline:
+        time.sleep(0.05)
+    assert not alive(pid)
+    # The version cache was written completely, without leaving temporary files
+    assert [p.name for p in site.iterdir()] == ["version_cache.json"]
+
+
+def test_mamba_version_from_conda_meta(tmp_path: pathlib.Path) -> None:
+    from ensureconda.api import determine_mamba_version
+
+    (tmp_path / "bin").mkdir()
+    (tmp_path / "conda-meta").mkdir()
+    # Never executed, since the version is taken from the package records
+    exe = tmp_path / "bin" / "mamba"
+    exe.write_text("")
+    (tmp_path / "conda-meta" / "mamba-1.5.8-py311h3072747_0.json").write_text("{}")
+    (tmp_path / "conda-meta" / "mamba-extra-9.9-0.json").write_text("{}")
+
+    assert determine_mamba_version(exe) == Version("1.5.8")
+
+
+@pytest.mark.skipif(os.name == "nt", reason="requires a POSIX shell script")
+def test_mamba_version_probe_timeout_runs_once(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    import appdirs
+
+    from ensureconda import api
+
+    monkeypatch.setattr(appdirs, "user_data_dir", lambda *a, **kw: str(tmp_path))
+    monkeypatch.setattr(api, "_version_cache", None)
+    monkeypatch.setattr(api, "VERSION_PROBE_TIMEOUT_SEC", 0.5)
+
+    counter = tmp_path / "calls"
+    exe = tmp_path / "mamba"
+    exe.write_text(f'#!/bin/sh\necho x >> "{counter}"\nsleep 10\n')
+    exe.chmod(0o755)
+
+    # A hanging executable is not cached, but must not be started a second time
+    # for the micromamba style fallback
+    assert api.determine_mamba_version(exe) == Version("0.0.0")
+    assert len(counter.read_text().splitlines()) == 1
+
+
+def _micromamba_tarball(content: bytes) -> bytes:
+    from ensureconda.resolve import is_windows
+
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:bz2") as tf:
+        info = tarfile.TarInfo(
+            "Library/bin/micromamba.exe" if is_windows else "bin/micromamba"
+        )
+        info.size = len(content)
+        tf.addfile(info, io.BytesIO(content))
+    return buf.getvalue()
+
+
+class _FakeResponse:
+    def __init__(
+        self,
+        status_code: int,
+        body: bytes = b"",
+        headers: Optional[Dict[str, str]] = None,
+    ) -> None:
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.raw = io.BytesIO(body)
+
+    def close(self) -> None:
+        pass
+
+
+def test_micromamba_conditional_download(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    import appdirs
+
+    from ensureconda import installer
+
+    monkeypatch.setattr(appdirs, "user_data_dir", lambda *a, **kw: str(tmp_path))
+    requested_headers: List[Dict[str, str]] = []
+    responses = [
+        _FakeResponse(
+            200,
+            _micromamba_tarball(b"micromamba v1"),
+            headers={"ETag": '"v1"', "Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT"},
+        ),
+        _FakeResponse(304),
+    ]
+
+    def fake_request(url: str, stream: bool = False, headers: Any = None) -> Any:
+        requested_headers.append(headers)
+        return responses.pop(0)
+
+    monkeypatch.setattr(installer, "request_url_with_retry", fake_request)
+
+    # Without a previous download the request is unconditional
+    exe = installer.install_micromamba()
+    assert exe is not None
+    assert exe.read_bytes() == b"micromamba v1"
+    assert requested_headers == [{}]
+    validators = json.loads(exe.with_name(f".{exe.name}.etag").read_text())
+    assert validators == {
+        "etag": '"v1"',
+        "last_modified": "Mon, 01 Jan 2024 00:00:00 GMT",
+    }
+
+    # Once stale, the saved validators are sent and a 304 only refreshes the mtime
+    stale = time.time() - 2 * installer.REDOWNLOAD_WHEN_OLDER_THAN_SEC
+    os.utime(exe, (stale, stale))
+    assert installer.install_micromamba() == exe
+    assert requested_headers[1] == {
+        "If-None-Match": '"v1"',
+        "If-Modified-Since": "Mon, 01 Jan 2024 00:00:00 GMT",
+    }
+    assert exe.read_bytes() == b"micromamba v1"
+    assert time.time() - exe.stat().st_mtime < 60
+    assert not responses
+
+
+def test_conditional_request_headers_without_validators(
+    tmp_path: pathlib.Path,
+) -> None:
+    from ensureconda.installer import conditional_request_headers
+
+    validators_path = tmp_path / ".micromamba.etag"
+    assert conditional_request_headers(validators_path) == {}
+    validators_path.write_text("{not json")
+    assert conditional_request_headers(validators_path) == {}
+    validators_path.write_text(json.dumps({"etag": None, "last_modified": 5}))
+    assert conditional_request_headers(validators_path) == {}
+
+
+@pytest.mark.skipif(os.name == "nt", reason="requires a POSIX shell script")
+def test_micromamba_installed_only_when_no_conda_suffices(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    import appdirs
+
+    from ensureconda import api, installer
+    from ensureconda.resolve import Candidate
+
+    monkeypatch.setattr(appdirs, "user_data_dir", lambda *a, **kw: str(tmp_path))
+    monkeypatch.setattr(api, "_version_cache", None)
+
+    conda = tmp_path / "conda"
+    conda.write_text('#!/bin/sh\necho "conda 4.9.0"\n')
+    conda.chmod(0o755)
+    micromamba = tmp_path / "micromamba"
+    monkeypatch.setattr(api, "micromamba_candidates", lambda: iter(()))
+    monkeypatch.setattr(
+        api, "conda_candidates", lambda: iter([Candidate.from_path(conda)])
+    )
+
+    installs: List[pathlib.Path] = []
+
+    def fake_install_micromamba() -> pathlib.Path:
+        installs.append(micromamba)
+        return micromamba
+
+    monkeypatch.setattr(installer, "install_micromamba", fake_install_micromamba)
+
+    def run(min_conda_version: str) -> Any:
+        return api.ensureconda(
+            mamba=False,
+            conda_exe=False,
+            min_conda_version=Version(min_conda_version),
+        )
+
+    # A suitable conda is used without installing micromamba
+    assert run("4.8.2") == conda
+    assert installs == []
+
+    # Only once conda is too old, micromamba gets installed
+    assert run("5.0") == micromamba
+    assert len(installs) == 1
+
+
+def test_session_retry_policy() -> None:
+    from urllib3.exceptions import ConnectTimeoutError
+
+    from ensureconda import installer
+
+    adapter: Any = installer.get_session().get_adapter("https://micro.mamba.pm")
+    retry = adapter.max_retries
+    assert isinstance(retry, installer._JitteredRetry)
+    assert retry.total == installer.HTTP_RETRIES
+    assert retry.is_retry("GET", 503)
+    assert not retry.is_retry("GET", 404)
+    for n in range(1, 4):
+        retry = retry.increment(method="GET", url="/", error=ConnectTimeoutError())
+        backoff = installer.HTTP_BACKOFF_FACTOR * 2 ** (n - 1)
+        assert backoff <= retry.get_backoff_time() <= 1.25 * backoff
+
+
+def test_interrupted_micromamba_download_is_restarted(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    import appdirs
+    from urllib3.exceptions import ProtocolError
+
+    from ensureconda import installer
+
+    monkeypatch.setattr(appdirs, "user_data_dir", lambda *a, **kw: str(tmp_path))
+    delays: List[float] = []
+    monkeypatch.setattr(time, "sleep", delays.append)
+
+    class BrokenBody(io.BytesIO):
+        """Connection drops while the executable is being written"""
+
+        def read(self, size: Optional[int] = -1) -> bytes:
+            if any(not p.name.endswith(".lock") for p in tmp_path.iterdir()):
+                raise ProtocolError("Connection broken")
+            return super().read(size)
+
+    content = os.urandom(4 << 20)
+    broken = _FakeResponse(200)
+    broken.raw = BrokenBody(_micromamba_tarball(content))
+    responses = [broken, _FakeResponse(200, _micromamba_tarball(content))]
+
+    def fake_request(url: str, stream: bool = False, headers: Any = None) -> Any:
+        return responses.pop(0)
+
+    monkeypatch.setattr(installer, "request_url_with_retry", fake_request)
+
+    exe = installer.install_micromamba()
+    assert exe is not None
+    assert not responses
+    assert exe.read_bytes() == content
+    assert len(delays) == 1
+    # The partially written executable was removed
+    assert {p.name for p in tmp_path.iterdir() if not p.name.endswith(".lock")} == {
+        exe.name,
+        f".{exe.name}.etag",
+    }
+
+
+def test_read_url_with_retry_gives_up(monkeypatch: pytest.MonkeyPatch) -> None:
+    import requests
+
+    from ensureconda import installer
+
+    delays: List[float] = []
+    monkeypatch.setattr(time, "sleep", delays.append)
+    monkeypatch.setattr(
+        installer, "request_url_with_retry", lambda *a, **kw: _FakeResponse(200)
+    )
+
+    def read(resp: Any) -> None:
+        raise requests.exceptions.ChunkedEncodingError("Connection broken")
+
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        installer.read_url_with_retry("https://example.invalid", read)
+    assert len(delays) == installer.HTTP_RETRIES
+    for n, delay in enumerate(delays, start=1):
+        backoff = installer.HTTP_BACKOFF_FACTOR * 2 ** (n - 1)
+        assert backoff <= delay <= 1.25 * backoff